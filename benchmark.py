@@ -0,0 +1,291 @@
+"""Офлайн-бенчмарк цикла обновления цен и рассылки уведомлений.
+
+Запускает send_update_to_users против локального фейкового card.wb.ru,
+MongoDB (локальной или в памяти через mongomock-motor) и заглушки Telegram-бота.
+
+Пример:
+    python benchmark.py --users 10000 --products 2000 --sizes 3 --cycles 3 --json
+
+Для сравнимых результатов используйте локальную MongoDB (--mongodb-uri):
+база в памяти сама по себе медленная и подходит только для проверки сценария.
+Внимание: база из --mongodb-uri очищается перед запуском.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+# Модуль бота читает настройки при импорте, поэтому задаем их заранее
+os.environ.setdefault('MONGODB_URI', 'mongodb://localhost:27017/wb_benchmark')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'benchmark')
+
+
+# Цена размера товара в копейках: меняется у доли товаров от цикла к циклу
+def fake_price(product_id, size_index, cycle, change_rate):
+    price = 100000 + (product_id * 7919 + size_index * 104729) % 900000
+    changes = sum(
+        1 for past_cycle in range(1, cycle + 1)
+        if random.Random(product_id * 1000003 + past_cycle).random() < change_rate
+    )
+    return price + changes * 1000
+
+
+def fake_card(product_id, sizes, cycle, change_rate):
+    return {
+        'id': product_id,
+        'name': f'Товар {product_id}',
+        'sizes': [
+            {'origName': f'S{size_index}', 'price': {'total': fake_price(product_id, size_index, cycle, change_rate)}}
+            for size_index in range(sizes)
+        ]
+    }
+
+
+# Фейковый card.wb.ru: HTTP/1.1 с keep-alive, задержкой и долей ошибок 503
+async def serve_fake_wb(port, sizes, latency, error_rate, change_rate, cycle, requests_count):
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+
+                requests_count.value += 1
+                if latency:
+                    await asyncio.sleep(latency)
+
+                query = parse_qs(urlsplit(request_line.split()[1].decode()).query)
+                if random.random() < error_rate:
+                    status, body = '503 Service Unavailable', b''
+                else:
+                    articles = [int(article) for article in query.get('nm', [''])[0].split(';') if article]
+                    products = [fake_card(article, sizes, cycle.value, change_rate) for article in articles]
+                    status, body = '200 OK', json.dumps({'data': {'products': products}}).encode()
+
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n'.encode() + body
+                )
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port)
+    async with server:
+        await server.serve_forever()
+
+
+def run_fake_wb(*args):
+    asyncio.run(serve_fake_wb(*args))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Обертка над коллекцией, считающая обращения к MongoDB по типам операций
+class CountingCollection:
+    def __init__(self, collection, counter):
+        self.collection = collection
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.counter[f'{self.collection.name}.{name}'] += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+# Заглушка Telegram-бота: только считает отправленные сообщения
+class StubBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class StubContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def connect_database(args):
+    if args.mongodb_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(args.mongodb_uri).get_database()
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit('Укажите --mongodb-uri или установите mongomock-motor для базы в памяти')
+    return AsyncMongoMockClient()['wb_benchmark']
+
+
+# Генерируем N пользователей, каждый подписан на несколько из M товаров с K размерами
+async def seed_database(bot, args):
+    rng = random.Random(args.seed)
+    product_records = {}
+    subscriptions = []
+    for chat_id in range(1, args.users + 1):
+        for product_id in rng.sample(range(1, args.products + 1), min(args.follows, args.products)):
+            size = f'S{rng.randrange(args.sizes)}' if args.sizes > 1 else None
+            size_index = int(size[1:]) if size else 0
+            product_records.setdefault((product_id, size), {
+                'product_id': product_id,
+                'size': size,
+                'name': f'Товар {product_id}',
+                'lastprice': fake_price(product_id, size_index, 0, args.change_rate) / 100,
+                'previous_price': fake_price(product_id, size_index, 0, args.change_rate) / 100,
+                'next_check_at': bot.first_check_at(product_id),
+                'refresh_interval': bot.REFRESH_DEFAULT_INTERVAL
+            })
+            subscriptions.append({'chat_id': chat_id, 'product_id': product_id, 'size': size})
+
+    await bot.ensure_indexes()
+    await bot.users_collection.insert_many([{'chat_id': chat_id} for chat_id in range(1, args.users + 1)])
+    await bot.products_collection.insert_many(list(product_records.values()))
+    await bot.subscriptions_collection.insert_many(subscriptions)
+    return len(product_records), len(subscriptions)
+
+
+async def run_benchmark(args):
+    port = free_port()
+    requests_count = multiprocessing.Value('i', 0)
+    cycle = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(
+        target=run_fake_wb,
+        args=(port, args.sizes, args.wb_latency, args.wb_error_rate, args.change_rate, cycle, requests_count),
+        daemon=True
+    )
+    server.start()
+
+    import priceCheckerBot as bot
+
+    bot.WB_CARD_URL = f'http://127.0.0.1:{port}/cards/v2/detail'
+    bot.WB_RETRY_BASE_DELAY = 0.01
+    bot.NOTIFY_RATE_PER_SECOND = args.notify_rate
+    bot.NOTIFY_BURST = max(1, int(args.notify_rate))
+
+    database = connect_database(args)
+    await database.client.drop_database(database.name)
+    mongo_ops = Counter()
+    for name in ('users', 'products', 'subscriptions', 'price_history', 'leases', 'price_changes'):
+        setattr(bot, f'{name}_collection', CountingCollection(database[name], mongo_ops))
+    bot.notifications_collection = CountingCollection(database['notification_batches'], mongo_ops)
+    if not args.mongodb_uri:
+        # mongomock не поддерживает $mod, база в памяти обновляется одной частью
+        bot.REFRESH_PARTITIONS = 1
+
+    product_records, subscriptions = await seed_database(bot, args)
+
+    # Ждем, пока фейковый сервер начнет принимать соединения
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+
+    results = []
+    stub_bot = StubBot(args.telegram_latency)
+    for cycle_number in range(1, args.cycles + 1):
+        cycle.value = cycle_number
+        requests_count.value = 0
+        mongo_ops.clear()
+        stub_bot.sent = 0
+        bot.product_cache.items.clear()
+        # Каждый цикл бенчмарка - отдельный запуск со своими арендами
+        bot.current_run_key = lambda: f'benchmark-{cycle.value}'
+
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        await bot.send_update_to_users(StubContext(stub_bot))
+        wall_time = time.perf_counter() - started_at
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({
+            'cycle': cycle_number,
+            'wall_time_s': round(wall_time, 3),
+            'http_requests': requests_count.value,
+            'mongo_ops': sum(mongo_ops.values()),
+            'mongo_ops_by_type': dict(sorted(mongo_ops.items())),
+            'messages_sent': stub_bot.sent,
+            'peak_memory_mb': round(peak_memory / 1024 / 1024, 2)
+        })
+
+    await bot.close_http_client()
+    server.terminate()
+
+    return {
+        'users': args.users,
+        'products': args.products,
+        'sizes': args.sizes,
+        'product_records': product_records,
+        'subscriptions': subscriptions,
+        'cycles': results
+    }
+
+
+def print_report(report):
+    print(f"Пользователей: {report['users']}, товаров: {report['products']}, размеров: {report['sizes']}, "
+          f"записей о ценах: {report['product_records']}, подписок: {report['subscriptions']}")
+    for result in report['cycles']:
+        print(f"Цикл {result['cycle']}: {result['wall_time_s']} с, HTTP-запросов {result['http_requests']}, "
+              f"операций MongoDB {result['mongo_ops']}, сообщений {result['messages_sent']}, "
+              f"пик памяти {result['peak_memory_mb']} МБ")
+        for operation, count in result['mongo_ops_by_type'].items():
+            print(f'    {operation}: {count}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк цикла обновления цен и рассылки')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--sizes', type=int, default=3)
+    parser.add_argument('--follows', type=int, default=5, help='подписок на одного пользователя')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--change-rate', type=float, default=0.1, help='доля товаров, меняющих цену за цикл')
+    parser.add_argument('--wb-latency', type=float, default=0.02, help='задержка ответа фейкового WB, с')
+    parser.add_argument('--wb-error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка отправки сообщения, с')
+    parser.add_argument('--notify-rate', type=float, default=1e6,
+                        help='лимит сообщений в секунду (по умолчанию без ограничения)')
+    parser.add_argument('--mongodb-uri', help='локальная MongoDB; без параметра используется база в памяти')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
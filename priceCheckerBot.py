@@ -1,209 +1,1310 @@
-import requests
+import httpx
 from telegram import ReplyKeyboardMarkup, Update
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes, MessageHandler, filters
+    Application, BaseUpdateProcessor, CommandHandler, ContextTypes, MessageHandler, filters
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+import asyncio
+import functools
 import logging
-from datetime import datetime
+import math
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+try:
+    import h2  # noqa: F401  HTTP/2 в httpx доступен только с пакетом h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 PRODUCTION = os.getenv('PROD')
+# Режим webhook вместо long polling: WEBHOOK=true и публичный адрес WEBHOOK_URL
+WEBHOOK = os.getenv('WEBHOOK')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Сколько обновлений обрабатывать одновременно (1 - последовательно)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
 mongodb_uri = os.getenv('MONGODB_URI')
 
+# Настройки HTTP-клиента для запросов к card.wb.ru
+WB_CARD_URL = os.getenv('WB_CARD_URL', 'https://card.wb.ru/cards/v2/detail')
+WB_CARD_PARAMS = 'appType=1&curr=rub&dest=-1257786&locale=ru&spp=30&lang=ru&ab_testing=false'
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '15'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '20'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '10'))
+
+# Настройки пакетной загрузки карточек при обновлении цен
+WB_CHUNK_SIZE = int(os.getenv('WB_CHUNK_SIZE', '100'))
+WB_CONCURRENCY = int(os.getenv('WB_CONCURRENCY', '4'))
+WB_MAX_RETRIES = int(os.getenv('WB_MAX_RETRIES', '3'))
+WB_RETRY_BASE_DELAY = float(os.getenv('WB_RETRY_BASE_DELAY', '0.5'))
+WB_RETRY_MAX_DELAY = float(os.getenv('WB_RETRY_MAX_DELAY', '10'))
+
+# Кэш карточек товаров и объединение запросов от команд /follow
+PRODUCT_CACHE_TTL = float(os.getenv('PRODUCT_CACHE_TTL', '300'))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', '10000'))
+LOOKUP_BATCH_WINDOW = float(os.getenv('LOOKUP_BATCH_WINDOW', '0.05'))
+
+# Настройки рассылки уведомлений: общий лимит Telegram около 30 сообщений в секунду
+# и не чаще одного сообщения в секунду в один чат
+NOTIFY_RATE_PER_SECOND = float(os.getenv('NOTIFY_RATE_PER_SECOND', '25'))
+NOTIFY_BURST = int(os.getenv('NOTIFY_BURST', '25'))
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv('NOTIFY_PER_CHAT_INTERVAL', '1'))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '16'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '3'))
+
+# Режим обновления цен: 'daily' - весь каталог раз в день, 'sliced' - товары
+# распределены по слотам суток и проверяются по мере наступления срока
+REFRESH_MODE = os.getenv('REFRESH_MODE', 'daily')
+REFRESH_SLICES = int(os.getenv('REFRESH_SLICES', '96'))
+REFRESH_SLICE_SECONDS = 24 * 60 * 60 / REFRESH_SLICES
+# Интервалы проверки одного товара в секундах: часто меняющиеся товары
+# проверяются чаще, стабильные реже
+REFRESH_DEFAULT_INTERVAL = float(os.getenv('REFRESH_DEFAULT_INTERVAL', str(24 * 60 * 60)))
+REFRESH_MIN_INTERVAL = float(os.getenv('REFRESH_MIN_INTERVAL', str(3 * 60 * 60)))
+REFRESH_MAX_INTERVAL = float(os.getenv('REFRESH_MAX_INTERVAL', str(72 * 60 * 60)))
+
+# История цен: ширина корзины в часах и параметры ответа команды /history
+PRICE_HISTORY_BUCKET_HOURS = int(os.getenv('PRICE_HISTORY_BUCKET_HOURS', '24'))
+PRICE_HISTORY_DEFAULT_DAYS = int(os.getenv('PRICE_HISTORY_DEFAULT_DAYS', '30'))
+PRICE_HISTORY_MAX_DAYS = int(os.getenv('PRICE_HISTORY_MAX_DAYS', '365'))
+PRICE_HISTORY_MAX_POINTS = int(os.getenv('PRICE_HISTORY_MAX_POINTS', '10'))
+
+# Размер пачки операций для bulk_write в MongoDB
+MONGO_BULK_BATCH_SIZE = int(os.getenv('MONGO_BULK_BATCH_SIZE', '1000'))
+
+# Настройки пула соединений с MongoDB
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '5'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '60000'))
+MONGO_TIMEOUT_MS = int(os.getenv('MONGO_TIMEOUT_MS', '5000'))
+
+# Работа нескольких копий бота: каталог делится на части по артикулу,
+# части и пачки уведомлений разбираются через аренды в MongoDB.
+# При нескольких копиях NOTIFY_RATE_PER_SECOND нужно делить между ними
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}'
+REFRESH_PARTITIONS = int(os.getenv('REFRESH_PARTITIONS', '8'))
+LEASE_TTL_SECONDS = float(os.getenv('LEASE_TTL_SECONDS', '300'))
+LEASE_POLL_SECONDS = float(os.getenv('LEASE_POLL_SECONDS', '15'))
+# Попытки обновить часть каталога, если запись в MongoDB не удалась, и пауза перед первым повтором
+REFRESH_WRITE_ATTEMPTS = int(os.getenv('REFRESH_WRITE_ATTEMPTS', '3'))
+REFRESH_WRITE_RETRY_DELAY = float(os.getenv('REFRESH_WRITE_RETRY_DELAY', '5'))
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', '200'))
+# Отметки об отправке сохраняются в пачке каждые N чатов или T секунд:
+# после падения копии повторно уйдут сообщения не больше чем одного окна
+NOTIFY_MARK_BATCH_SIZE = int(os.getenv('NOTIFY_MARK_BATCH_SIZE', '50'))
+NOTIFY_MARK_INTERVAL = float(os.getenv('NOTIFY_MARK_INTERVAL', '2'))
+# Сколько хранить выполненные аренды и разосланные пачки
+COORDINATION_RETENTION_SECONDS = int(os.getenv('COORDINATION_RETENTION_SECONDS', str(7 * 24 * 60 * 60)))
+
+# Метрики: порт HTTP-эндпоинта /metrics (не задан - эндпоинт выключен),
+# время на чтение запроса и чаты администраторов, которым доступна команда /stats
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_REQUEST_TIMEOUT = float(os.getenv('METRICS_REQUEST_TIMEOUT', '5'))
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()}
+
+# Метрики бота в памяти процесса: счетчики и длительности операций с метками.
+# Отдаются в текстовом формате Prometheus и командой /stats
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total, maximum = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    # Замер длительности блока кода: with metrics.timer('name', label=...)
+    @contextmanager
+    def timer(self, name, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def render_prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f'# TYPE {name} counter')
+                declared.add(name)
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for (name, labels), (count, total, _) in timings:
+            if name not in declared:
+                lines.append(f'# TYPE {name} summary')
+                declared.add(name)
+            lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {total:.6f}')
+        for (name, labels), (_, _, maximum) in timings:
+            if f'{name}_max' not in declared:
+                lines.append(f'# TYPE {name}_max gauge')
+                declared.add(f'{name}_max')
+            lines.append(f'{name}_max{self.format_labels(labels)} {maximum:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    # Короткая сводка для администратора
+    def render_summary(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        lines = []
+        for (name, labels), (count, total, maximum) in timings:
+            lines.append(f'{name}{self.format_labels(labels)}: n={count}, '
+                         f'ср. {total / count * 1000:.1f} мс, макс. {maximum * 1000:.1f} мс')
+        for (name, labels), value in counters:
+            lines.append(f'{name}{self.format_labels(labels)}: {value}')
+        return '\n'.join(lines) or 'Метрик пока нет.'
+
+metrics = Metrics()
+
+# Декоратор для замера длительности асинхронных функций
+def timed(name, **labels):
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(name, **labels):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Счетчик и длительность команд MongoDB на уровне драйвера
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe('mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.inc('mongo_command_errors_total', command=event.command_name)
+
 # Ensure the URI is available
 if not mongodb_uri:
     raise ValueError("MONGODB_URI is not set in the environment")
 
-# Connect to MongoDB
-client = MongoClient(mongodb_uri)
+if WEBHOOK == 'true' and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode")
+
+# Connect to MongoDB (асинхронный драйвер, запросы не блокируют цикл событий бота)
+client = AsyncIOMotorClient(
+    mongodb_uri,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+    event_listeners=[MongoCommandMetrics()]
+)
 
 # Access the database (replace 'appdb' with your database name if needed)
 db = client.get_database()  # This will use the database specified in the URI
 
 # Example usage: Access a collection and perform an operation
 users_collection = db['users']
+# Одна запись о цене на пару (товар, размер) и подписки пользователей на эти записи
+products_collection = db['products']
+subscriptions_collection = db['subscriptions']
+# История цен: один документ на товар, размер и временную корзину
+price_history_collection = db['price_history']
+# Аренды частей каталога, журнал изменений цен и очередь пачек уведомлений
+leases_collection = db['leases']
+price_changes_collection = db['price_changes']
+notifications_collection = db['notification_batches']
 
+# Общий асинхронный HTTP-клиент с пулом keep-alive соединений
+http_client = None
 
-# Функция для добавления пользователя в базу данных, если его нет
-def add_user_if_not_exists(chat_id):
-    existing_user = users_collection.find_one({'chat_id': chat_id})
-    if not existing_user:
-        users_collection.insert_one({'chat_id': chat_id, 'followed_products': []})
+def get_http_client():
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE
+            )
+        )
+    return http_client
 
-def follow_product(chat_id, product_id, name, price, size=None):
-    add_user_if_not_exists(chat_id)
-    users_collection.update_one(
-        {'chat_id': chat_id},
-        {'$addToSet': {'followed_products': {
-            'product_id': product_id,
-            'name': name,
-            'lastprice': price,
-            'size': size,
-            'previous_price': price,
-            'has_changed': False,
-            'last_updated': datetime.now()
-        }}}
+# Закрываем пул соединений при остановке бота
+async def close_http_client(application=None):
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+# Компактные записи карточек: из ответа WB храним только артикул, название и цены размеров
+class SizePrice:
+    __slots__ = ('name', 'price')
+
+    def __init__(self, name, price):
+        self.name = name
+        self.price = price
+
+class ProductCard:
+    __slots__ = ('product_id', 'name', 'sizes')
+
+    def __init__(self, product_id, name, sizes):
+        self.product_id = product_id
+        self.name = name
+        self.sizes = sizes
+
+    # Цены с ключом (артикул, размер); ключ (артикул, None) - цена первого размера
+    def price_items(self):
+        if self.sizes:
+            yield (self.product_id, None), self.sizes[0].price
+        for size in self.sizes:
+            yield (self.product_id, size.name), size.price
+
+# Разбираем тело ответа card.wb.ru в список ProductCard, остальные поля сразу отбрасываются.
+# Цена размера, которого нет в наличии, равна None
+def parse_product_cards(content):
+    cards = []
+    for product in json_loads(content).get('data', {}).get('products', []):
+        try:
+            sizes = tuple(
+                SizePrice(size['origName'], size['price']['total'] / 100 if 'price' in size else None)
+                for size in product.get('sizes', [])
+            )
+            cards.append(ProductCard(product['id'], product['name'], sizes))
+        except (KeyError, TypeError) as e:
+            print(f"Ошибка при извлечении данных о товаре: {e}")
+    return cards
+
+# Функция для получения карточек товаров по списку артикулов
+async def fetch_product_cards(articles):
+    started_at = time.perf_counter()
+    try:
+        response = await get_http_client().get(generate_url(articles))
+        response.raise_for_status()
+        return parse_product_cards(response.content)
+    except httpx.HTTPStatusError as e:
+        metrics.inc('wb_request_errors_total', reason=e.response.status_code)
+        raise
+    except (httpx.HTTPError, ValueError) as e:
+        metrics.inc('wb_request_errors_total', reason=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('wb_request_seconds', time.perf_counter() - started_at)
+
+# Разбиваем список артикулов на пачки фиксированного размера
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Повторять имеет смысл только сетевые ошибки, 429 и ответы 5xx
+def is_retryable_error(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (httpx.HTTPError, ValueError))
+
+# Загрузка одной пачки с повторами: экспоненциальная задержка со случайным разбросом
+async def fetch_chunk_with_retries(chunk, semaphore):
+    for attempt in range(WB_MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                return await fetch_product_cards(chunk)
+        except (httpx.HTTPError, ValueError) as e:
+            if attempt == WB_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            metrics.inc('wb_retries_total')
+            delay = min(WB_RETRY_MAX_DELAY, WB_RETRY_BASE_DELAY * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            logging.warning(f"Ошибка при загрузке пачки из {len(chunk)} товаров (попытка {attempt + 1}): {e}. "
+                            f"Повтор через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+# Функция для загрузки карточек большого числа товаров:
+# возвращает найденные товары и артикулы из пачек, которые так и не удалось загрузить
+async def fetch_products_batched(articles):
+    chunks = list(chunked(articles, WB_CHUNK_SIZE))
+    semaphore = asyncio.Semaphore(WB_CONCURRENCY)
+    results = await asyncio.gather(
+        *(fetch_chunk_with_retries(chunk, semaphore) for chunk in chunks),
+        return_exceptions=True
+    )
+
+    products = []
+    failed_articles = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logging.error(f"Пачка из {len(chunk)} товаров не загружена: {result}")
+            metrics.inc('wb_batches_total', status='failed')
+            failed_articles.extend(chunk)
+        else:
+            metrics.inc('wb_batches_total', status='ok')
+            products.extend(result)
+    return products, failed_articles
+
+
+# Кэш карточек товаров в памяти процесса: запись живет ttl секунд,
+# при переполнении вытесняется давно не использованная
+class ProductCardCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, article):
+        item = self.items.get(article)
+        if item is None:
+            return None
+        expires_at, card = item
+        if expires_at < time.monotonic():
+            del self.items[article]
+            return None
+        self.items.move_to_end(article)
+        return card
+
+    def put(self, article, card):
+        self.items[article] = (time.monotonic() + self.ttl, card)
+        self.items.move_to_end(article)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+# Поиск карточек для команд пользователей. Одновременные запросы одного артикула
+# ждут один и тот же запрос, а запросы, пришедшие в течение окна, объединяются в один multi-nm запрос
+class ProductLookup:
+    def __init__(self, cache, window, max_batch):
+        self.cache = cache
+        self.window = window
+        self.max_batch = max_batch
+        self.in_flight = {}
+        self.queued = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def get(self, article):
+        card = self.cache.get(article)
+        if card is not None:
+            return card
+
+        future = self.in_flight.get(article)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.in_flight[article] = future
+            self.queued.append(article)
+            if len(self.queued) >= self.max_batch:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        articles, self.queued = self.queued, []
+        if articles:
+            task = asyncio.create_task(self.fetch(articles))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def fetch(self, articles):
+        try:
+            cards = {card.product_id: card for card in await fetch_product_cards(articles)}
+        except Exception as e:
+            for article in articles:
+                future = self.in_flight.pop(article)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for article in articles:
+            card = cards.get(article)
+            if card is not None:
+                self.cache.put(article, card)
+            future = self.in_flight.pop(article)
+            if not future.done():
+                future.set_result(card)
+
+product_cache = ProductCardCache(PRODUCT_CACHE_TTL, PRODUCT_CACHE_SIZE)
+product_lookup = ProductLookup(product_cache, LOOKUP_BATCH_WINDOW, WB_CHUNK_SIZE)
+
+# Создаем индексы для пользователей, товаров и подписок
+async def ensure_indexes():
+    await users_collection.create_index('chat_id', unique=True)
+    await products_collection.create_index([('product_id', ASCENDING), ('size', ASCENDING)], unique=True)
+    await subscriptions_collection.create_index(
+        [('chat_id', ASCENDING), ('product_id', ASCENDING), ('size', ASCENDING)], unique=True
+    )
+    # Индекс порогов: подписки товара отсортированы по целевой цене
+    await subscriptions_collection.create_index(
+        [('product_id', ASCENDING), ('size', ASCENDING), ('target_price', ASCENDING)]
+    )
+    await products_collection.create_index('next_check_at')
+    await price_history_collection.create_index(
+        [('product_id', ASCENDING), ('bucket_start', ASCENDING), ('size', ASCENDING)], unique=True
+    )
+    await leases_collection.create_index('created_at', expireAfterSeconds=COORDINATION_RETENTION_SECONDS)
+    await price_changes_collection.create_index('status')
+    await price_changes_collection.create_index('notify_key')
+    await price_changes_collection.create_index('created_at', expireAfterSeconds=COORDINATION_RETENTION_SECONDS)
+    await notifications_collection.create_index([('status', ASCENDING), ('expires_at', ASCENDING)])
+    await notifications_collection.create_index('created_at', expireAfterSeconds=COORDINATION_RETENTION_SECONDS)
+
+# Отправляем накопленные операции пачками через неупорядоченный bulk_write.
+# Ошибки одной пачки логируются и не мешают записи остальных
+async def flush_bulk_writes(collection, operations):
+    written = 0
+    failed = 0
+    for batch in chunked(operations, MONGO_BULK_BATCH_SIZE):
+        try:
+            with metrics.timer('mongo_bulk_write_seconds', collection=collection.name):
+                result = await collection.bulk_write(batch, ordered=False)
+            written += result.matched_count + result.upserted_count
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            written += e.details.get('nMatched', 0) + e.details.get('nUpserted', 0)
+            failed += len(write_errors)
+            metrics.inc('mongo_bulk_write_errors_total', len(write_errors), collection=collection.name)
+            logging.error(f"Ошибка пакетной записи в {collection.name}: "
+                          f"{len(write_errors)} из {len(batch)} операций не выполнены. "
+                          f"Первая ошибка: {write_errors[0]['errmsg'] if write_errors else e}")
+        except PyMongoError as e:
+            failed += len(batch)
+            metrics.inc('mongo_bulk_write_errors_total', len(batch), collection=collection.name)
+            logging.error(f"Пачка из {len(batch)} операций в {collection.name} не записана: {e}")
+    return written, failed
+
+# Время первой проверки товара: начало его слота суток, слот определяется по артикулу
+def first_check_at(product_id, now=None):
+    now = now or datetime.now()
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    check_at = day_start + timedelta(seconds=(product_id % REFRESH_SLICES) * REFRESH_SLICE_SECONDS)
+    if check_at <= now:
+        check_at += timedelta(days=1)
+    return check_at
+
+# Дневной бюджет проверок части каталога: столько проверок дали бы все ее товары
+# с обычным интервалом. Частые проверки меняющихся товаров расходуют тот же бюджет,
+# поэтому адаптивные интервалы не увеличивают общее число запросов к WB
+def refresh_budget_key(partition, now):
+    return f'refresh-budget:{now:%Y-%m-%d}:{partition}'
+
+async def refresh_budget_left(partition, now):
+    total = await products_collection.estimated_document_count()
+    if partition is not None and REFRESH_PARTITIONS > 1:
+        total /= REFRESH_PARTITIONS
+    budget = math.ceil(total * 24 * 60 * 60 / REFRESH_DEFAULT_INTERVAL)
+    usage = await leases_collection.find_one({'_id': refresh_budget_key(partition, now)}, {'used': 1})
+    return max(0, budget - (usage or {}).get('used', 0))
+
+async def spend_refresh_budget(partition, now, checks):
+    await leases_collection.update_one(
+        {'_id': refresh_budget_key(partition, now)},
+        {'$inc': {'used': checks}, '$setOnInsert': {'created_at': now}},
+        upsert=True
     )
 
-# Функция для удаления товара из массива followed_products
-def unfollow_product(chat_id, product_id):
-    users_collection.update_one(
+# Подстраиваем интервал проверки под то, как часто меняется цена товара
+def next_refresh_interval(interval, has_changed):
+    if has_changed:
+        return max(REFRESH_MIN_INTERVAL, interval / 2)
+    return min(REFRESH_MAX_INTERVAL, interval * 1.25)
+
+# Распределяем по слотам товары, у которых еще нет времени следующей проверки
+async def schedule_unscheduled_products():
+    now = datetime.now()
+    operations = [
+        UpdateOne({'_id': record['_id']}, {'$set': {
+            'next_check_at': first_check_at(record['product_id'], now),
+            'refresh_interval': REFRESH_DEFAULT_INTERVAL
+        }})
+        async for record in products_collection.find({'next_check_at': {'$exists': False}}, {'product_id': 1})
+    ]
+    await flush_bulk_writes(products_collection, operations)
+
+# Переносим подписки из старого формата users.followed_products в коллекции products и subscriptions
+async def migrate_followed_products():
+    product_ops = []
+    subscription_ops = []
+    migrated_users = []
+
+    async for user in users_collection.find({'followed_products': {'$exists': True}}):
+        chat_id = user['chat_id']
+        for product in user.get('followed_products', []):
+            product_id = product['product_id']
+            size = product.get('size')
+            product_ops.append(UpdateOne(
+                {'product_id': product_id, 'size': size},
+                {'$setOnInsert': {
+                    'name': product['name'],
+                    'lastprice': product['lastprice'],
+                    'previous_price': product.get('previous_price', product['lastprice']),
+                    'last_updated': product.get('last_updated', datetime.now())
+                }},
+                upsert=True
+            ))
+            subscription_ops.append(UpdateOne(
+                {'chat_id': chat_id, 'product_id': product_id, 'size': size},
+                {'$setOnInsert': {'created_at': product.get('last_updated', datetime.now())}},
+                upsert=True
+            ))
+        migrated_users.append(user['_id'])
+
+    if not migrated_users:
+        return
+
+    _, products_failed = await flush_bulk_writes(products_collection, product_ops)
+    _, subscriptions_failed = await flush_bulk_writes(subscriptions_collection, subscription_ops)
+    # Старые списки удаляем только после полного переноса, иначе повторим его при следующем запуске
+    if products_failed or subscriptions_failed:
+        logging.error(f'Перенос подписок не завершен: ошибок записи {products_failed + subscriptions_failed}, '
+                      f'старые списки товаров сохранены')
+        return
+    await users_collection.update_many({'_id': {'$in': migrated_users}}, {'$unset': {'followed_products': ''}})
+    print(f'Перенесены подписки {len(migrated_users)} пользователей ({len(subscription_ops)} товаров)')
+
+# Функция для добавления пользователя в базу данных, если его нет (один upsert)
+@timed('mongo_helper_seconds', helper='add_user_if_not_exists')
+async def add_user_if_not_exists(chat_id):
+    await users_collection.update_one(
         {'chat_id': chat_id},
-        {'$pull': {'followed_products': {'product_id': product_id}}}
+        {'$setOnInsert': {'created_at': datetime.now()}},
+        upsert=True
+    )
+
+# Пользователь и подписка создаются независимыми upsert-запросами, поэтому отправляем
+# их одновременно. Запись о цене создаем вторым запросом после подписки: если параллельный
+# /unfollow удалит ее как лишнюю, этот upsert создаст ее заново (см. remove_orphan_products).
+# Поэтому подписка стоит две последовательные задержки до MongoDB, а не одну
+@timed('mongo_helper_seconds', helper='follow_product')
+async def follow_product(chat_id, product_id, name, price, size=None, target_price=None):
+    upsert_subscription = subscriptions_collection.update_one(
+        {'chat_id': chat_id, 'product_id': product_id, 'size': size},
+        {'$set': {'target_price': target_price},
+         '$setOnInsert': {'created_at': datetime.now()}},
+        upsert=True
+    )
+    await asyncio.gather(add_user_if_not_exists(chat_id), upsert_subscription)
+
+    # Запись о цене общая для всех подписчиков товара и размера
+    await products_collection.update_one(
+        {'product_id': product_id, 'size': size},
+        {'$set': {'name': name},
+         '$setOnInsert': {
+             'lastprice': price,
+             'previous_price': price,
+             'last_updated': datetime.now(),
+             'next_check_at': first_check_at(product_id),
+             'refresh_interval': REFRESH_DEFAULT_INTERVAL
+         }},
+        upsert=True
     )
 
-# Функция для получения всех пользователей
-def get_all_users():
-    return users_collection.find()
+# Удаляем записи о товарах, на которые больше никто не подписан
+@timed('mongo_helper_seconds', helper='remove_orphan_products')
+async def remove_orphan_products(keys):
+    for product_id, size in set(keys):
+        key = {'product_id': product_id, 'size': size}
+        if await subscriptions_collection.find_one(key):
+            continue
+        product = await products_collection.find_one_and_delete(key)
+        # Подписка могла появиться между проверкой и удалением: тогда возвращаем запись.
+        # Подписки, созданные позже, восстановят ее сами в follow_product
+        if product and await subscriptions_collection.find_one(key):
+            restored = {field: value for field, value in product.items() if field not in ('_id', 'product_id', 'size')}
+            await products_collection.update_one(key, {'$setOnInsert': restored}, upsert=True)
+
+# Функция для удаления товара из списка отслеживаемых
+@timed('mongo_helper_seconds', helper='unfollow_product')
+async def unfollow_product(chat_id, product_id):
+    subscriptions = await subscriptions_collection.find({'chat_id': chat_id, 'product_id': product_id}).to_list(None)
+    if subscriptions:
+        await subscriptions_collection.delete_many({'chat_id': chat_id, 'product_id': product_id})
+        await remove_orphan_products((s['product_id'], s['size']) for s in subscriptions)
 
 # Функция для получения списка товаров, на которые подписан пользователь
-def get_user_products(chat_id):
-    user = users_collection.find_one({'chat_id': chat_id})
-    if user:
-        return user['followed_products']
-    return []
+@timed('mongo_helper_seconds', helper='get_user_products')
+async def get_user_products(chat_id):
+    subscriptions = await subscriptions_collection.find({'chat_id': chat_id}).to_list(None)
+    if not subscriptions:
+        return []
 
+    products = products_collection.find({'$or': [
+        {'product_id': s['product_id'], 'size': s['size']} for s in subscriptions
+    ]})
+    products_by_key = {(p['product_id'], p['size']): p async for p in products}
+    return [{**products_by_key[(s['product_id'], s['size'])], 'target_price': s.get('target_price')}
+            for s in subscriptions if (s['product_id'], s['size']) in products_by_key]
 
-async def update_product_data():
-    print('Обновление данных о продуктах')
-    all_users = get_all_users()
-    unique_product_ids = set()
+# Начало временного окна (корзины) истории цен, в которое попадает момент времени
+def history_bucket_start(moment):
+    bucket_seconds = PRICE_HISTORY_BUCKET_HOURS * 60 * 60
+    timestamp = moment.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % bucket_seconds)
+
+# Операция записи цены в историю: точки упакованы в массив документа корзины,
+# рядом хранятся агрегаты корзины, чтобы не читать сами точки при запросах
+def price_history_operation(product_id, size, price, moment):
+    return UpdateOne(
+        {'product_id': product_id, 'size': size, 'bucket_start': history_bucket_start(moment)},
+        {'$push': {'points': [moment, price]},
+         '$inc': {'count': 1, 'sum': price},
+         '$min': {'min': price},
+         '$max': {'max': price},
+         '$set': {'last_price': price}},
+        upsert=True
+    )
+
+# Функция для получения агрегатов истории цен товара за последние days дней
+@timed('mongo_helper_seconds', helper='get_price_history')
+async def get_price_history(product_id, days):
+    since = history_bucket_start(datetime.now() - timedelta(days=days))
+    buckets = price_history_collection.find(
+        {'product_id': product_id, 'bucket_start': {'$gte': since}},
+        {'points': 0}
+    ).sort('bucket_start', ASCENDING)
+    history = {}
+    async for bucket in buckets:
+        history.setdefault(bucket['size'], []).append(bucket)
+    return history
+
+# Сводка по корзинам: минимум, максимум, среднее и не больше max_points точек,
+# соседние корзины объединяются по их агрегатам
+def summarize_price_history(buckets, max_points):
+    count = sum(bucket['count'] for bucket in buckets)
+    summary = {
+        'min': min(bucket['min'] for bucket in buckets),
+        'max': max(bucket['max'] for bucket in buckets),
+        'avg': sum(bucket['sum'] for bucket in buckets) / count,
+        'points': []
+    }
+    group_size = -(-len(buckets) // max_points)
+    for group in chunked(buckets, group_size):
+        summary['points'].append((
+            group[0]['bucket_start'],
+            sum(bucket['sum'] for bucket in group) / sum(bucket['count'] for bucket in group)
+        ))
+    return summary
 
-    for user in all_users:
-        followed_products = user.get('followed_products', [])
-        for product in followed_products:
-            unique_product_ids.add(product['product_id'])
+# Событие изменения цены, которое обновление передает напрямую в рассылку
+PriceChange = namedtuple('PriceChange', ['product_id', 'size', 'name', 'old_price', 'new_price'])
+
+# Функция обновляет цены и возвращает список изменений цен.
+# С due_only=True обновляются только товары, срок проверки которых наступил,
+# с partition - только одна часть каталога (остаток от деления артикула).
+# Проверки по сроку ограничены дневным бюджетом: сначала самые просроченные товары,
+# остальные дождутся следующего слота
+async def update_product_data(due_only=False, partition=None, journal_key=None):
+    print('Обновление данных о продуктах')
+    now = datetime.now()
+    query = {'next_check_at': {'$lte': now}} if due_only else {}
+    if partition is not None and REFRESH_PARTITIONS > 1:
+        query['product_id'] = {'$mod': [REFRESH_PARTITIONS, partition]}
+    # Каждая пара (товар, размер) хранится один раз, сколько бы пользователей ее ни отслеживало
+    with metrics.timer('refresh_phase_seconds', phase='load'):
+        cursor = products_collection.find(query, {'product_id': 1, 'size': 1, 'lastprice': 1, 'refresh_interval': 1})
+        if due_only:
+            budget = await refresh_budget_left(partition, now)
+            if not budget:
+                logging.warning(f"Дневной бюджет проверок части {partition} исчерпан")
+                return []
+            cursor = cursor.sort('next_check_at', ASCENDING).limit(budget)
+        product_records = await cursor.to_list(None)
+    if due_only and product_records:
+        await spend_refresh_budget(partition, now, len(product_records))
+    unique_product_ids = {record['product_id'] for record in product_records}
 
     if not unique_product_ids:
-        return
+        return []
 
-    # Формируем запрос с артикулами
-    article_list = ';'.join(map(str, unique_product_ids))
-    url = f'https://card.wb.ru/cards/v2/detail?appType=1&curr=rub&dest=-1257786&locale=ru&spp=30&lang=ru&ab_testing=false&nm={article_list}'
-    
+    # Загружаем карточки товаров пачками, неудачные пачки не срывают весь цикл
+    with metrics.timer('refresh_phase_seconds', phase='fetch'):
+        products_data, failed_articles = await fetch_products_batched(unique_product_ids)
+    if failed_articles:
+        logging.warning(f"Не удалось обновить {len(failed_articles)} из {len(unique_product_ids)} товаров")
+
+    compute_started_at = time.perf_counter()
+    names = {}
+    prices = {}
+    for card in products_data:
+        names[card.product_id] = card.name
+        prices.update(card.price_items())
+        # Свежие карточки пригодятся командам /follow
+        product_cache.put(card.product_id, card)
+
+    # Изменения накапливаются и записываются пачками
+    operations = []
+    history_operations = []
+    changes = []
+    failed_ids = set(failed_articles)
+    for record in product_records:
+        interval = record.get('refresh_interval', REFRESH_DEFAULT_INTERVAL)
+        # Товары, которые не удалось проверить, откладываем на обычный интервал
+        postpone = UpdateOne({'_id': record['_id']}, {'$set': {'next_check_at': now + timedelta(seconds=interval)}})
+
+        name = names.get(record['product_id'])
+        if name is None:
+            # Товары из незагруженных пачек остаются в очереди до следующего запуска
+            if record['product_id'] not in failed_ids:
+                operations.append(postpone)
+            continue
+
+        size_to_track = record.get('size')
+        old_price = record['lastprice']
+        new_price = prices.get((record['product_id'], size_to_track))
+
+        if new_price is None:
+            print(f"Цена размера {size_to_track} не найдена для товара {name}. Пропускаем.")
+            operations.append(postpone)
+            continue
+
+        history_operations.append(price_history_operation(record['product_id'], size_to_track, new_price, now))
+
+        # Проверяем изменение цены
+        has_changed = new_price != old_price
+        interval = next_refresh_interval(interval, has_changed)
+        update = {
+            'name': name,
+            'last_updated': now,
+            'refresh_interval': interval,
+            'next_check_at': now + timedelta(seconds=interval)
+        }
+        if has_changed:
+            update.update({'lastprice': new_price, 'previous_price': old_price})
+            changes.append(PriceChange(record['product_id'], size_to_track, name, old_price, new_price))
+
+        operations.append(UpdateOne({'_id': record['_id']}, {'$set': update}))
+
+    metrics.observe('refresh_phase_seconds', time.perf_counter() - compute_started_at, phase='compute')
+    metrics.inc('refresh_products_checked_total', len(product_records))
+    metrics.inc('refresh_price_changes_total', len(changes))
+
+    with metrics.timer('refresh_phase_seconds', phase='write'):
+        # Изменения попадают в журнал до записи новых цен: если журнал не записан,
+        # цены не трогаем, и повторная обработка найдет те же изменения
+        if changes and journal_key is not None and not await record_price_changes(changes, journal_key):
+            logging.error(f"Не удалось записать журнал изменений {journal_key}, цены не сохранены")
+            return None
+        _, failed = await flush_bulk_writes(products_collection, operations)
+        if failed:
+            # Часть обработаем повторно, и точки истории запишутся тогда: иначе повтор
+            # добавил бы те же наблюдения в корзины второй раз
+            logging.warning(f"Не удалось сохранить {failed} из {len(operations)} обновлений цен")
+        else:
+            await flush_bulk_writes(price_history_collection, history_operations)
+    # None - часть каталога нужно обработать повторно
+    return None if failed else changes
+
+# Формируем текст уведомления об изменении цены
+def format_price_change(product_id, name, last_price, previous_price):
+    price_diff = last_price - previous_price
+    price_diff_percent = (price_diff / previous_price) * 100 if previous_price > 0 else 0
+    change_direction = "выросла" if price_diff > 0 else "упала"
+
+    return (f'Товар: {name}\n'
+            f'Новая цена: {last_price} руб.\n'
+            f'Цена {change_direction} на {abs(price_diff)} руб. ({abs(price_diff_percent):.2f}%)\n'
+            f'Ссылка: https://www.wildberries.ru/catalog/{product_id}/detail.aspx')
+
+# Формируем текст уведомления о достижении целевой цены
+def format_target_reached(product_id, name, last_price, target_price):
+    return (f'Товар: {name}\n'
+            f'Цена снизилась до {last_price} руб. и достигла вашей цели {target_price} руб.\n'
+            f'Ссылка: https://www.wildberries.ru/catalog/{product_id}/detail.aspx')
+
+# Разбираем порог из команды /follow: число - целевая цена, число с % - снижение в процентах
+def parse_alert_threshold(text):
+    if text.endswith('%'):
+        percent = float(text[:-1].replace(',', '.'))
+        if not math.isfinite(percent) or not 0 < percent < 100:
+            raise ValueError(text)
+        return 'percent', percent
+    target_price = float(text.replace(',', '.'))
+    # nan и inf проходят сравнения, но никогда не попадут в диапазон срабатывания
+    if not math.isfinite(target_price) or target_price <= 0:
+        raise ValueError(text)
+    return 'price', target_price
+
+# Целевая цена по порогу и текущей цене товара
+def compute_target_price(threshold, price):
+    kind, value = threshold
+    if kind == 'percent':
+        return round(price * (1 - value / 100), 2)
+    return value
+
+# Собираем уведомления по пользователям: читаем подписки только изменившихся товаров.
+# Подписчики без порога получают любое изменение цены, подписчики с порогом - только
+# снижение через цель. Их находим диапазоном по индексу порогов (цель в [новая цена,
+# старая цена)), не читая остальных подписчиков товара
+@timed('mongo_helper_seconds', helper='group_changes_by_chat')
+async def group_changes_by_chat(changes):
+    changes_by_key = {(change.product_id, change.size): change for change in changes}
+    messages_by_chat = {}
+
+    drops = [change for change in changes if change.new_price < change.old_price]
+    for batch in chunked(drops, MONGO_BULK_BATCH_SIZE):
+        subscriptions = subscriptions_collection.find(
+            {'$or': [
+                {'product_id': change.product_id, 'size': change.size,
+                 'target_price': {'$gte': change.new_price, '$lt': change.old_price}}
+                for change in batch
+            ]},
+            {'chat_id': 1, 'product_id': 1, 'size': 1, 'target_price': 1}
+        )
+        async for subscription in subscriptions:
+            change = changes_by_key[(subscription['product_id'], subscription['size'])]
+            messages_by_chat.setdefault(subscription['chat_id'], []).append(
+                format_target_reached(change.product_id, change.name, change.new_price, subscription['target_price'])
+            )
+
+    for product_ids in chunked({change.product_id for change in changes}, MONGO_BULK_BATCH_SIZE):
+        subscriptions = subscriptions_collection.find(
+            {'product_id': {'$in': product_ids}, 'target_price': None},
+            {'chat_id': 1, 'product_id': 1, 'size': 1}
+        )
+        async for subscription in subscriptions:
+            change = changes_by_key.get((subscription['product_id'], subscription['size']))
+            if change is None:
+                continue
+            messages_by_chat.setdefault(subscription['chat_id'], []).append(
+                format_price_change(change.product_id, change.name, change.new_price, change.old_price)
+            )
+    return messages_by_chat
+
+# Функция для отправки обновлений пользователям. Каждая копия бота забирает
+# свободные части каталога, обновляет их и записывает изменения в журнал. Затем одна
+# из копий собирает уведомления запуска по чатам, и все копии рассылают пачки из очереди
+@timed('cycle_seconds')
+async def send_update_to_users(context: ContextTypes.DEFAULT_TYPE, due_only=False):
+    run_key = current_run_key()
+    deadline = time.monotonic() + refresh_period_seconds()
+    partitions = list(range(REFRESH_PARTITIONS))
+    random.shuffle(partitions)
+
+    while partitions:
+        busy_partitions = []
+        for partition in partitions:
+            lease_key = f'refresh:{run_key}:{partition}'
+            state = await claim_lease(lease_key)
+            if state == 'busy':
+                busy_partitions.append(partition)
+            if state != 'claimed':
+                continue
+
+            async with holding_lease(leases_collection, lease_key):
+                for attempt in range(REFRESH_WRITE_ATTEMPTS):
+                    if attempt:
+                        await asyncio.sleep(REFRESH_WRITE_RETRY_DELAY * 2 ** (attempt - 1))
+                    with metrics.timer('notify_phase_seconds', phase='refresh'):
+                        changes = await update_product_data(due_only=due_only, partition=partition, journal_key=lease_key)
+                    if changes is not None:
+                        break
+            if changes is None:
+                # Цены не сохранены, поэтому изменения найдутся при следующем запуске.
+                # Аренду не завершаем и переходим к остальным частям и рассылке
+                logging.error(f"Часть {partition} не обновлена за {REFRESH_WRITE_ATTEMPTS} попыток, отложена до следующего запуска")
+                continue
+            await complete_lease(lease_key)
+
+        # Ждем части, занятые другими копиями: если копия упала, ее аренда истечет
+        partitions = busy_partitions
+        if partitions:
+            if time.monotonic() + LEASE_POLL_SECONDS > deadline:
+                break
+            await asyncio.sleep(LEASE_POLL_SECONDS)
+
+    # Кроме текущего запуска достраиваем сборки, брошенные упавшими копиями
+    notify_key = f'notify:{run_key}'
+    stale_keys = await price_changes_collection.distinct('notify_key', {'status': 'grouping'})
+    for key in [notify_key] + [key for key in stale_keys if key != notify_key]:
+        if await claim_lease(key) != 'claimed':
+            continue
+        async with holding_lease(leases_collection, key):
+            with metrics.timer('notify_phase_seconds', phase='group'):
+                queued = await enqueue_notifications(key)
+        if queued:
+            await complete_lease(key)
+
+    with metrics.timer('notify_phase_seconds', phase='dispatch'):
+        stats = await dispatch_notification_batches(context.bot)
+    for status, count in stats.items():
+        metrics.inc('notifications_total', count, status=status)
+    print(f"Уведомления: отправлено {stats['sent']}, ошибок {stats['failed']}, заблокировали бота {stats['blocked']}")
+
+# Аренда (lease) работы в MongoDB: несколько копий бота делят обновление каталога
+# между собой. Аренда истекает сама, если владелец упал, и ее подхватывает другая копия
+async def claim_lease(key):
+    now = datetime.now()
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        products_data = data['data']['products']
-
-        # Обновляем данные о товарах для всех пользователей
-        for product_data in products_data:
-            product_id = product_data['id']
-            name = product_data['name']
-
-            # Итерируем по пользователям, которые отслеживают данный товар
-            users = users_collection.find({'followed_products.product_id': product_id})
-            for user in users:
-                for followed_product in user['followed_products']:
-                    if followed_product['product_id'] == product_id:
-                        size_to_track = followed_product.get('size')
-                        old_price = followed_product['lastprice']
-                        has_changed = followed_product.get('has_changed', False)
-
-                        # Если размер указан, ищем цену конкретного размера
-                        if size_to_track:
-                            # Ищем цену для выбранного размера
-                            new_price = None
-                            for size in product_data['sizes']:
-                                if size['origName'] == size_to_track:
-                                    new_price = size['price']['total'] / 100
-                                    break
-
-                            if new_price is None:
-                                print(f"Размер {size_to_track} не найден для товара {name}. Пропускаем.")
-                                continue
-                        else:
-                            # Если размер не указан, берем цену первого размера
-                            new_price = product_data['sizes'][0]['price']['total'] / 100
-
-                        # Проверяем изменение цены
-                        if new_price != old_price:
-                            has_changed = True
-                            price_difference = new_price - old_price
-                            percentage_change = (price_difference / old_price) * 100
-                        else:
-                            has_changed = False
-
-                        # Обновляем товар для пользователя
-                        users_collection.update_one(
-                            {'chat_id': user['chat_id'], 'followed_products.product_id': product_id},
-                            {'$set': {
-                                'followed_products.$.name': name,
-                                'followed_products.$.lastprice': new_price,
-                                'followed_products.$.previous_price': old_price,  # Сохраняем старую цену
-                                'followed_products.$.has_changed': has_changed,
-                                'followed_products.$.last_updated': datetime.now()
-                            }}
-                        )
-    except requests.RequestException as e:
-        logging.error(f"Ошибка при обновлении данных о товарах: {e}")
-        
+        await leases_collection.find_one_and_update(
+            {'_id': key, 'done': {'$ne': True},
+             '$or': [{'expires_at': {'$lt': now}}, {'owner': WORKER_ID}]},
+            {'$set': {'owner': WORKER_ID, 'expires_at': now + timedelta(seconds=LEASE_TTL_SECONDS)},
+             '$setOnInsert': {'created_at': now}},
+            upsert=True
+        )
+        return 'claimed'
+    except DuplicateKeyError:
+        # Аренда уже есть: либо работа выполнена, либо ее держит другая копия
+        lease = await leases_collection.find_one({'_id': key}, {'done': 1})
+        return 'done' if lease and lease.get('done') else 'busy'
 
-# Функция для отправки обновлений пользователям
-async def send_update_to_users(context: ContextTypes.DEFAULT_TYPE):
-    await update_product_data()
-    all_users = get_all_users()
+async def complete_lease(key):
+    await leases_collection.update_one({'_id': key, 'owner': WORKER_ID}, {'$set': {'done': True}})
 
-    for user in all_users:
-        chat_id = user['chat_id']
-        followed_products = user.get('followed_products', [])
-
-        if followed_products:
-            messages = []
-            for product in followed_products:
-                if product.get('has_changed', False):
-                    product_id = product['product_id']
-                    name = product['name']
-                    last_price = product['lastprice']
-                    previous_price = product.get('previous_price', last_price)
-
-                    # Рассчитываем изменение цены
-                    price_diff = last_price - previous_price
-                    price_diff_percent = (price_diff / previous_price) * 100 if previous_price > 0 else 0
-                    change_direction = "выросла" if price_diff > 0 else "упала"
-                    
-                    messages.append(f'Товар: {name}\n'
-                                    f'Новая цена: {last_price} руб.\n'
-                                    f'Цена {change_direction} на {abs(price_diff)} руб. ({abs(price_diff_percent):.2f}%)\n'
-                                    f'Ссылка: https://www.wildberries.ru/catalog/{product_id}/detail.aspx')
-
-                    # Сброс флага has_changed и обновление previous_price
-                    users_collection.update_one(
-                        {'chat_id': chat_id, 'followed_products.product_id': product['product_id']},
-                        {'$set': {'followed_products.$.has_changed': False,
-                                  'followed_products.$.previous_price': last_price}}  # Обновляем previous_price
-                    )
+# Продлеваем аренду (поле expires_at), пока идет долгая работа
+@asynccontextmanager
+async def holding_lease(collection, lease_id):
+    async def renew():
+        while True:
+            await asyncio.sleep(LEASE_TTL_SECONDS / 3)
+            await collection.update_one(
+                {'_id': lease_id, 'owner': WORKER_ID},
+                {'$set': {'expires_at': datetime.now() + timedelta(seconds=LEASE_TTL_SECONDS)}}
+            )
+
+    renew_task = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renew_task.cancel()
+
+# Период запуска обновления: у всех копий в одном периоде одинаковый ключ запуска
+def refresh_period_seconds():
+    if REFRESH_MODE == 'sliced':
+        return REFRESH_SLICE_SECONDS
+    if PRODUCTION == 'true':
+        return 24 * 60 * 60
+    return 60
+
+def current_run_key():
+    return int(time.time() // refresh_period_seconds())
+
+# Журнал изменений цен: записи детерминированы ключом аренды части каталога,
+# поэтому повторная обработка части не создает дублей
+async def record_price_changes(changes, key):
+    now = datetime.now()
+    operations = [
+        UpdateOne(
+            {'_id': f'{key}:{index}'},
+            {'$setOnInsert': {
+                'changes': [list(change) for change in batch],
+                'status': 'pending',
+                'created_at': now
+            }},
+            upsert=True
+        )
+        for index, batch in enumerate(chunked(changes, MONGO_BULK_BATCH_SIZE))
+    ]
+    _, failed = await flush_bulk_writes(price_changes_collection, operations)
+    return not failed
+
+# Сводим изменения из журнала: если пара (товар, размер) менялась несколько раз,
+# уведомляем о разнице между первой старой и последней новой ценой
+def merge_price_changes(entries):
+    merged = {}
+    for entry in entries:
+        for item in entry['changes']:
+            change = PriceChange(*item)
+            key = (change.product_id, change.size)
+            if key in merged:
+                change = change._replace(old_price=merged[key].old_price)
+            merged[key] = change
+    return [change for change in merged.values() if change.new_price != change.old_price]
+
+# Кладем уведомления запуска в очередь пачками по NOTIFY_BATCH_SIZE чатов. Изменения всех
+# частей каталога группируются по чатам один раз, поэтому пользователь получает одно
+# сообщение за запуск. Записи журнала сначала закрепляются за ключом сборки, а пачки
+# получают детерминированные идентификаторы: повторная сборка после падения не создает дублей
+async def enqueue_notifications(key):
+    lease = await leases_collection.find_one({'_id': key}, {'frozen': 1})
+    if not lease.get('frozen'):
+        await price_changes_collection.update_many(
+            {'status': 'pending'}, {'$set': {'status': 'grouping', 'notify_key': key}}
+        )
+        await leases_collection.update_one({'_id': key, 'owner': WORKER_ID}, {'$set': {'frozen': True}})
+
+    entries = await price_changes_collection.find({'notify_key': key}).sort(
+        [('created_at', ASCENDING), ('_id', ASCENDING)]
+    ).to_list(None)
+    changes = merge_price_changes(entries)
+    messages_by_chat = await group_changes_by_chat(changes) if changes else {}
+    operations = [
+        UpdateOne(
+            {'_id': f'{key}:{index}'},
+            {'$setOnInsert': {
+                'messages': batch,
+                'status': 'pending',
+                'sent_chat_ids': [],
+                'created_at': datetime.now()
+            }},
+            upsert=True
+        )
+        for index, batch in enumerate(chunked(sorted(messages_by_chat.items()), NOTIFY_BATCH_SIZE))
+    ]
+    _, failed = await flush_bulk_writes(notifications_collection, operations)
+    if failed:
+        logging.error(f"Не удалось поставить в очередь {failed} пачек уведомлений сборки {key}")
+        return False
+
+    await price_changes_collection.update_many({'notify_key': key}, {'$set': {'status': 'queued'}})
+    return True
+
+# Забираем пачку уведомлений: новую или брошенную упавшей копией
+async def claim_notification_batch():
+    now = datetime.now()
+    return await notifications_collection.find_one_and_update(
+        {'$or': [{'status': 'pending'}, {'status': 'sending', 'expires_at': {'$lt': now}}]},
+        {'$set': {'status': 'sending', 'owner': WORKER_ID,
+                  'expires_at': now + timedelta(seconds=LEASE_TTL_SECONDS)}},
+        return_document=ReturnDocument.AFTER
+    )
+
+# Рассылаем все пачки из очереди одним отправителем, чтобы лимиты и паузы RetryAfter
+# действовали на всю рассылку. Отправленные чаты отмечаются в пачке небольшими порциями
+# и при повторной обработке пачки пропускаются
+async def dispatch_notification_batches(bot):
+    dispatcher = NotificationDispatcher(bot)
+    while True:
+        batch = await claim_notification_batch()
+        if batch is None:
+            return dispatcher.stats
 
-            if messages:
-                message = '\n\n'.join(messages)
-                await context.bot.send_message(chat_id=chat_id, text=message, disable_web_page_preview=True)
+        already_sent = set(batch.get('sent_chat_ids', []))
+        messages_by_chat = {
+            chat_id: messages for chat_id, messages in batch['messages'] if chat_id not in already_sent
+        }
+
+        unsaved_chat_ids = []
+        saved_at = time.monotonic()
+
+        async def save_sent(batch_id=batch['_id']):
+            nonlocal saved_at
+            chat_ids = unsaved_chat_ids[:]
+            unsaved_chat_ids.clear()
+            saved_at = time.monotonic()
+            if chat_ids:
+                await notifications_collection.update_one(
+                    {'_id': batch_id, 'owner': WORKER_ID}, {'$addToSet': {'sent_chat_ids': {'$each': chat_ids}}}
+                )
+
+        async def mark_sent(chat_id):
+            unsaved_chat_ids.append(chat_id)
+            if (len(unsaved_chat_ids) >= NOTIFY_MARK_BATCH_SIZE
+                    or time.monotonic() - saved_at >= NOTIFY_MARK_INTERVAL):
+                await save_sent()
+
+        async with holding_lease(notifications_collection, batch['_id']):
+            await dispatcher.send_all(messages_by_chat, on_processed=mark_sent)
+            await save_sent()
+
+        await notifications_collection.update_one(
+            {'_id': batch['_id'], 'owner': WORKER_ID}, {'$set': {'status': 'sent'}}
+        )
+
+# Ограничитель частоты отправки по алгоритму token bucket
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    # Останавливаем выдачу токенов, например после ответа RetryAfter
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Разбиваем длинный текст на части не длиннее лимита Telegram,
+# стараясь резать по границам уведомлений, затем по строкам
+def split_message(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    parts = []
+    current = ''
+    for block in text.split('\n\n'):
+        candidate = f'{current}\n\n{block}' if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        while len(block) > limit:
+            cut = block.rfind('\n', 0, limit)
+            if cut <= 0:
+                cut = limit
+            parts.append(block[:cut])
+            block = block[cut:].lstrip('\n')
+        current = block
+    if current:
+        parts.append(current)
+    return parts
+
+# Удаляем подписки пользователя, который заблокировал бота
+@timed('mongo_helper_seconds', helper='remove_user')
+async def remove_user(chat_id):
+    await clear_followed_products(chat_id)
+    await users_collection.delete_one({'chat_id': chat_id})
+
+# Очередь рассылки: несколько отправителей с общим ограничением частоты.
+# Сообщения одному чату отправляет один отправитель, по порядку и с паузой между частями
+class NotificationDispatcher:
+    def __init__(self, bot, rate=None, burst=None, workers=None, per_chat_interval=None):
+        self.bot = bot
+        self.bucket = TokenBucket(rate or NOTIFY_RATE_PER_SECOND, burst or NOTIFY_BURST)
+        self.workers = workers or NOTIFY_WORKERS
+        self.per_chat_interval = NOTIFY_PER_CHAT_INTERVAL if per_chat_interval is None else per_chat_interval
+        self.stats = {'sent': 0, 'failed': 0, 'blocked': 0}
+        self.blocked_chats = []
+        self.on_processed = None
+
+    async def send_all(self, messages_by_chat, on_processed=None):
+        # on_processed вызывается для чатов, которые больше не нужно пытаться уведомить:
+        # сообщение отправлено или бот заблокирован
+        self.on_processed = on_processed
+        queue = asyncio.Queue()
+        for chat_id, messages in messages_by_chat.items():
+            queue.put_nowait((chat_id, split_message('\n\n'.join(messages))))
+
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(min(self.workers, queue.qsize()))]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        for chat_id in self.blocked_chats:
+            await remove_user(chat_id)
+        self.blocked_chats.clear()
+        return self.stats
+
+    async def worker(self, queue):
+        while True:
+            chat_id, parts = await queue.get()
+            try:
+                await self.send_chat(chat_id, parts)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logging.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def send_chat(self, chat_id, parts):
+        for index, part in enumerate(parts):
+            if index:
+                await asyncio.sleep(self.per_chat_interval)
+            if not await self.send_part(chat_id, part):
+                if chat_id in self.blocked_chats:
+                    await self.mark_processed(chat_id)
+                return
+        self.stats['sent'] += 1
+        await self.mark_processed(chat_id)
+
+    async def mark_processed(self, chat_id):
+        if self.on_processed is None:
+            return
+        try:
+            await self.on_processed(chat_id)
+        except PyMongoError as e:
+            logging.error(f"Не удалось отметить отправку в чат {chat_id}: {e}")
+
+    async def send_part(self, chat_id, text):
+        for attempt in range(NOTIFY_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                with metrics.timer('telegram_send_seconds'):
+                    await self.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+                return True
+            except RetryAfter as e:
+                metrics.inc('telegram_retry_after_total')
+                # Telegram просит подождать: приостанавливаем всю рассылку
+                self.bucket.pause(e.retry_after)
+                logging.warning(f"Превышен лимит Telegram, пауза {e.retry_after} с")
+            except Forbidden:
+                self.stats['blocked'] += 1
+                self.blocked_chats.append(chat_id)
+                return False
+            except BadRequest:
+                raise
+            except NetworkError:
+                if attempt == NOTIFY_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+        self.stats['failed'] += 1
+        return False
 
 def generate_url(articles):
     if articles:
         articles_str = ';'.join(map(str, articles))
-        return f'https://card.wb.ru/cards/v2/detail?appType=1&curr=rub&dest=-1257786&locale=ru&spp=30&lang=ru&ab_testing=false&nm={articles_str}'
+        return f'{WB_CARD_URL}?{WB_CARD_PARAMS}&nm={articles_str}'
     return None
 
-def extract_product_data(data):
-    products = data.get('data', {}).get('products', [])
+def extract_product_data(content):
     product_list = []
-    for product in products:
-        try:
-            name = product['name']
-            price = product['sizes'][0]['price']['total'] / 100
-            product_list.append({'name': name, 'price': price})
-        except (KeyError, IndexError) as e:
-            print(f"Ошибка при извлечении данных о товаре: {e}")
+    for card in parse_product_cards(content):
+        if card.sizes and card.sizes[0].price is not None:
+            product_list.append({'name': card.name, 'price': card.sizes[0].price})
+        else:
+            print(f"Нет цены для товара {card.product_id}")
     return product_list
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -224,10 +1325,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                     '/help\n'
                     'Показывает список доступных команд\n\n'
 
-                    '/follow <артикул товара>\n'
-                    'Добавляет товар для отслеживания по артикулу.\n' 
+                    '/follow <артикул товара> [целевая цена или снижение в %]\n'
+                    'Добавляет товар для отслеживания по артикулу. Если указан порог, уведомление придет только когда цена опустится до цели.\n' 
                     'Пример:\n'
-                    '```\n/follow 12345678\n```\n'
+                    '```\n/follow 12345678\n/follow 12345678 1500\n/follow 12345678 10%\n```\n'
 
                     '/unfollow <артикул товара>\n'
                     'Удаляет товар из списка отслеживаемых.\n' 
@@ -240,6 +1341,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                     '/check\n'
                     'Показывает текущий список отслеживаемых товаров с их ценами.\n\n'
 
+                    '/history <артикул товара> [дней]\n'
+                    'Показывает минимальную, максимальную и среднюю цену товара за период (по умолчанию 30 дней).\n'
+                    'Пример:\n'
+                    '```\n/history 12345678 7\n```\n'
+
                     '/how\n'
                     'Краткое описание того, как работает этот бот.'
                 )
@@ -252,21 +1358,39 @@ async def follow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:
         try:
             article_number = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text('Пожалуйста, введите действительный артикул товара.')
+            return
 
-            # Формируем запрос на получение информации о товаре
-            url = f'https://card.wb.ru/cards/v2/detail?appType=1&curr=rub&dest=-1257786&locale=ru&spp=30&lang=ru&ab_testing=false&nm={article_number}'
-            response = requests.get(url)
-            data = response.json()
+        threshold = None
+        if len(context.args) > 1:
+            try:
+                threshold = parse_alert_threshold(context.args[1])
+            except ValueError:
+                await update.message.reply_text('Пожалуйста, укажите целевую цену (например, 1500) или снижение в процентах (например, 10%).')
+                return
 
+        try:
+            # Запрашиваем информацию о товаре (из кэша или общим запросом)
             try:
-                product = data['data']['products'][0]
-                name = product['name']
-                sizes = product.get('sizes', [])
+                product = await product_lookup.get(article_number)
+            except (httpx.HTTPError, ValueError) as e:
+                logging.error(f"Ошибка при запросе данных о товаре {article_number}: {e}")
+                await update.message.reply_text('Не удалось получить данные о товаре. Попробуйте позже.')
+                return
+
+            if product is None:
+                await update.message.reply_text(f'Товар с артикулом {article_number} не найден.')
+                return
+
+            try:
+                name = product.name
+                sizes = product.sizes
 
                 # Проверяем, есть ли у товара несколько размеров
                 if len(sizes) > 1:
                     # Отправляем пользователю выбор размеров
-                    size_options = [f"{size['origName']}" for size in sizes]
+                    size_options = [size.name for size in sizes]
                     size_keyboard = [[option] for option in size_options]
                     reply_markup = ReplyKeyboardMarkup(size_keyboard, one_time_keyboard=True)
                     
@@ -274,6 +1398,7 @@ async def follow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     context.user_data['article_number'] = article_number
                     context.user_data['name'] = name
                     context.user_data['sizes'] = sizes
+                    context.user_data['threshold'] = threshold
                     context.user_data['awaiting_size_selection'] = True  # Устанавливаем флаг для ожидания выбора размера
                     
                     await update.message.reply_text(
@@ -282,14 +1407,20 @@ async def follow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     )
                 else:
                     # Если размер один, сразу добавляем товар
-                    price = sizes[0]['price']['total'] / 100
-                    follow_product(update.message.chat_id, article_number, name, price)
+                    price = sizes[0].price
+                    if price is None:
+                        await update.message.reply_text(f'{name} нет в наличии.')
+                        return
+                    target_price = compute_target_price(threshold, price) if threshold else None
+                    if target_price is not None and target_price >= price:
+                        await update.message.reply_text(f'Текущая цена {price} руб. уже не выше цели {target_price} руб.')
+                        return
+                    await follow_product(update.message.chat_id, article_number, name, price, target_price=target_price)
                     await update.message.reply_text(f'Артикул {article_number} добавлен в список.')
 
             except (KeyError, IndexError) as e:
                 print(f"Ошибка при извлечении данных о товаре: {e}")
                 await update.message.reply_text('Ошибка при получении данных о товаре.')
-                
         except ValueError:
             await update.message.reply_text('Пожалуйста, введите действительный артикул товара.')
     else:
@@ -302,19 +1433,23 @@ async def handle_size_selection(update: Update, context: ContextTypes.DEFAULT_TY
         sizes = context.user_data.get('sizes', [])
         article_number = context.user_data.get('article_number')
         name = context.user_data.get('name')
+        threshold = context.user_data.get('threshold')
 
         # Ищем выбранный размер среди доступных
-        selected_size = next((size for size in sizes if size_selected.startswith(size['origName'])), None)
-        print(selected_size)
+        selected_size = next((size for size in sizes if size_selected.startswith(size.name)), None)
 
         if selected_size:
-            sizeName = f"{selected_size['origName']}"
-            try:
-                price = selected_size['price']['total'] / 100
-                follow_product(update.message.chat_id, article_number, name, price, size=sizeName)
-                await update.message.reply_text(f'{name} с размером {sizeName} добавлен в список отслеживаемых.')
-            except:
+            sizeName = selected_size.name
+            price = selected_size.price
+            target_price = compute_target_price(threshold, price) if threshold and price is not None else None
+            if price is None:
                 await update.message.reply_text(f'{name} с размером {sizeName} нет в наличии.')
+            elif target_price is not None and target_price >= price:
+                await update.message.reply_text(f'Текущая цена {price} руб. уже не выше цели {target_price} руб.')
+            else:
+                await follow_product(update.message.chat_id, article_number, name, price,
+                                     size=sizeName, target_price=target_price)
+                await update.message.reply_text(f'{name} с размером {sizeName} добавлен в список отслеживаемых.')
         else:
             await update.message.reply_text('Выбранный размер не найден.')
         
@@ -325,7 +1460,7 @@ async def unfollow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:
         try:
             article_number = int(context.args[0])
-            unfollow_product(update.message.chat_id, article_number)
+            await unfollow_product(update.message.chat_id, article_number)
             await update.message.reply_text(f'Артикул {article_number} удален из списка.')
         except ValueError:
             await update.message.reply_text('Пожалуйста, введите действительное числовое значение.')
@@ -333,29 +1468,28 @@ async def unfollow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text('Пожалуйста, укажите артикул товара для удаления.')
 
 # Функция для очистки всех товаров пользователя
-def clear_followed_products(chat_id):
-    users_collection.update_one(
-        {'chat_id': chat_id},
-        {'$set': {'followed_products': []}}  # Очищаем массив товаров
-    )
+@timed('mongo_helper_seconds', helper='clear_followed_products')
+async def clear_followed_products(chat_id):
+    subscriptions = await subscriptions_collection.find({'chat_id': chat_id}).to_list(None)
+    if subscriptions:
+        await subscriptions_collection.delete_many({'chat_id': chat_id})
+        await remove_orphan_products((s['product_id'], s['size']) for s in subscriptions)
 
 # Обработчик команды /clear
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    clear_followed_products(chat_id)
+    await clear_followed_products(chat_id)
     await update.message.reply_text('Ваш список товаров был успешно очищен.')
 
 # Функция для получения информации о текущих отслеживаемых товарах пользователя
 async def check_followed_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    user = users_collection.find_one({'chat_id': chat_id})
+    followed_products = await get_user_products(chat_id)
     
-    if not user or not user.get('followed_products'):
+    if not followed_products:
         await update.message.reply_text('У вас нет отслеживаемых товаров.')
         return
     
-    followed_products = user['followed_products']
-    
     # Формируем сообщение с информацией о каждом отслеживаемом товаре
     messages = []
     for product in followed_products:
@@ -363,25 +1497,197 @@ async def check_followed_products(update: Update, context: ContextTypes.DEFAULT_
         name = product['name']
         size = product.get('size', None)
         price = product['lastprice']
+        target_price = product.get('target_price')
+        target_line = f'Цель: {target_price} руб.\n' if target_price is not None else ''
     
         messages.append(f'Артикул: {product_id}.\n'
                         f'Товар: {name}\n'
                         f'Размер: {size}\n'
                         f'Цена: {price} руб.\n'
+                        f'{target_line}'
                         f'Ссылка: https://www.wildberries.ru/catalog/{product_id}/detail.aspx')
         
     message = '\n\n'.join(messages)
     await update.message.reply_text(message, disable_web_page_preview=True)
 
+# Обработчик команды /history: статистика цены товара за период
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args:
+        await update.message.reply_text('Пожалуйста, укажите артикул товара.')
+        return
+
+    try:
+        article_number = int(context.args[0])
+        days = int(context.args[1]) if len(context.args) > 1 else PRICE_HISTORY_DEFAULT_DAYS
+    except ValueError:
+        await update.message.reply_text('Пожалуйста, введите действительный артикул товара и число дней.')
+        return
+
+    if days <= 0:
+        await update.message.reply_text('Число дней должно быть положительным.')
+        return
+    if days > PRICE_HISTORY_MAX_DAYS:
+        await update.message.reply_text(f'Историю можно запросить не больше чем за {PRICE_HISTORY_MAX_DAYS} дн.')
+        return
+
+    price_history = await get_price_history(article_number, days)
+    if not price_history:
+        await update.message.reply_text(f'Истории цен для артикула {article_number} пока нет.')
+        return
+
+    messages = []
+    for size, buckets in price_history.items():
+        summary = summarize_price_history(buckets, PRICE_HISTORY_MAX_POINTS)
+        points = '\n'.join(f'{moment:%d.%m %H:%M}: {price:.2f} руб.' for moment, price in summary['points'])
+        messages.append(f'Артикул: {article_number}\n'
+                        f'Размер: {size}\n'
+                        f'За {days} дн.: мин. {summary["min"]} руб., макс. {summary["max"]} руб., '
+                        f'средняя {summary["avg"]:.2f} руб.\n'
+                        f'{points}')
+
+    for part in split_message('\n\n'.join(messages)):
+        await update.message.reply_text(part)
+
+# Обработчик команды /stats: сводка метрик для администраторов
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.chat_id not in ADMIN_CHAT_IDS:
+        await update.message.reply_text('Команда доступна только администраторам.')
+        return
+
+    for part in split_message(metrics.render_summary()):
+        await update.message.reply_text(part)
+
+# Замеряем длительность и ошибки обработчиков команд
+def timed_handler(command, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started_at = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', command=command)
+            raise
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - started_at, command=command)
+    return wrapper
+
+# HTTP-эндпоинт /metrics в текстовом формате Prometheus
+metrics_server = None
+
+async def read_request_line(reader):
+    request_line = await reader.readline()
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+    return request_line
+
+async def handle_metrics_request(reader, writer):
+    try:
+        # Медленный или молчащий клиент не должен держать соединение вечно
+        request_line = await asyncio.wait_for(read_request_line(reader), METRICS_REQUEST_TIMEOUT)
+
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', metrics.render_prometheus().encode()
+        else:
+            status, body = '404 Not Found', b''
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, int(METRICS_PORT))
+        print(f'Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+# Параллельная обработка обновлений с сохранением порядка внутри одного чата:
+# обновления разных чатов идут одновременно, одного чата - строго друг за другом,
+# поэтому выбор размера после /follow не обгоняет саму команду
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Семафор PTB берется до do_process_update, и обновления, ждущие очереди своего чата,
+    # занимали бы общие слоты. Поэтому его лимит практически снят, а слот собственного
+    # семафора берется только после блокировки чата
+    UNBOUNDED = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNBOUNDED)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            async with self.slots:
+                await coroutine
+            return
+
+        lock, waiters = self.chat_locks.get(chat.id, (asyncio.Lock(), 0))
+        self.chat_locks[chat.id] = (lock, waiters + 1)
+        try:
+            async with lock, self.slots:
+                await coroutine
+        finally:
+            lock, waiters = self.chat_locks[chat.id]
+            if waiters == 1:
+                del self.chat_locks[chat.id]
+            else:
+                self.chat_locks[chat.id] = (lock, waiters - 1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Готовим хранилище при запуске: индексы и перенос подписок из старого формата
+async def init_storage(application):
+    await ensure_indexes()
+    await migrate_followed_products()
+    await schedule_unscheduled_products()
+
+async def on_startup(application):
+    await init_storage(application)
+    await start_metrics_server()
+
+async def on_shutdown(application):
+    await stop_metrics_server()
+    await close_http_client()
+
 def main() -> None:
     # Создаем объект Application и передаем ему токен
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
     print('Запускаем Бота')
 
     # Настраиваем планировщик
     scheduler = AsyncIOScheduler()
     
-    if PRODUCTION == 'true':
+    if REFRESH_MODE == 'sliced':
+        # Каждый слот суток проверяем товары, срок проверки которых наступил
+        scheduler.add_job(send_update_to_users, trigger=IntervalTrigger(seconds=REFRESH_SLICE_SECONDS),
+                          args=[application], kwargs={'due_only': True})
+    elif PRODUCTION == 'true':
         # Каждый день в 11 утра
         scheduler.add_job(send_update_to_users, trigger=CronTrigger(hour=11, minute=0), args=[application])
     else:
@@ -391,19 +1697,37 @@ def main() -> None:
     scheduler.start()
     
     # Регистрируем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("how", how))
-    application.add_handler(CommandHandler("follow", follow))
-    application.add_handler(CommandHandler("unfollow", unfollow))
-    application.add_handler(CommandHandler("clear", clear))
-    application.add_handler(CommandHandler("check", check_followed_products))
+    commands = {
+        "start": start,
+        "help": help_command,
+        "how": how,
+        "follow": follow,
+        "unfollow": unfollow,
+        "clear": clear,
+        "check": check_followed_products,
+        "history": history,
+        "stats": stats,
+    }
+    for command, callback in commands.items():
+        application.add_handler(CommandHandler(command, timed_handler(command, callback)))
 
     # Обработчик для текстовых сообщений (для обработки выбора размера)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_size_selection))
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, timed_handler('size_selection', handle_size_selection)
+    ))
 
     # Запускаем бота
-    application.run_polling()
+    if WEBHOOK == 'true':
+        # Telegram присылает секрет в заголовке, запросы без него отклоняются
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()